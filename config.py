@@ -40,15 +40,16 @@ census_pop_growths = {
 # 19 July: Most remaining restrictions lifted
 # https://www.instituteforgovernment.org.uk/sites/default/files/2022-12/timeline-coronavirus-lockdown-december-2021.pdf
 
-corona_periods = {
-    "First lockdown": [pd.Timestamp(year=2020, month=3, day=26), pd.Timestamp(year=2020, month=5, day=9)],
-    "Step-wise loosening of restrictions": [pd.Timestamp(year=2020, month=5, day=10), pd.Timestamp(year=2020, month=10, day=13)],
-    "Regional tier system introduced": [pd.Timestamp(year=2020, month=10, day=14), pd.Timestamp(year=2020, month=11, day=4)],
-    "Second lockdown": [pd.Timestamp(year=2020, month=11, day=5), pd.Timestamp(year=2020, month=12, day=1)],
-    "New tier system introduced": [pd.Timestamp(year=2020, month=12, day=2), pd.Timestamp(year=2021, month=1, day=5)],
-    "Third lockdown": [pd.Timestamp(year=2021, month=1, day=6), pd.Timestamp(year=2021, month=3, day=7)],
-    "Step-wise loosening of restrictions": [pd.Timestamp(year=2021, month=3, day=8), pd.Timestamp(year=2021, month=7, day=18)]
-}
+# list rather than dict, as period names repeat
+corona_periods = [
+    ("First lockdown", pd.Timestamp(year=2020, month=3, day=26), pd.Timestamp(year=2020, month=5, day=9)),
+    ("Step-wise loosening of restrictions", pd.Timestamp(year=2020, month=5, day=10), pd.Timestamp(year=2020, month=10, day=13)),
+    ("Regional tier system introduced", pd.Timestamp(year=2020, month=10, day=14), pd.Timestamp(year=2020, month=11, day=4)),
+    ("Second lockdown", pd.Timestamp(year=2020, month=11, day=5), pd.Timestamp(year=2020, month=12, day=1)),
+    ("New tier system introduced", pd.Timestamp(year=2020, month=12, day=2), pd.Timestamp(year=2021, month=1, day=5)),
+    ("Third lockdown", pd.Timestamp(year=2021, month=1, day=6), pd.Timestamp(year=2021, month=3, day=7)),
+    ("Step-wise loosening of restrictions", pd.Timestamp(year=2021, month=3, day=8), pd.Timestamp(year=2021, month=7, day=18))
+]
 
 # animal keyword lookup
 animal_keywords = {
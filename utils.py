@@ -1,129 +1,217 @@
 import glob
-import holidays
+import hashlib
+import os
+import re
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+import numpy as np
 import pandas as pd
 from urllib.request import urlopen
 import xml.etree.ElementTree as ET
 from pathlib import Path
-import geopandas as gpd
-import prophet
-from prophet.plot import plot_plotly, plot_components_plotly
-from nltk import ngrams
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
+
+
+# messy, manual reallocation of old wards to new ones post 2018
+ward_renames = {
+    "St. Peter's": 'St Peters',
+    "St Peter's": 'St Peters',
+    "St. Michael's": "St Michael's",
+    "St. Pauls": 'St Pauls',
+    'Bushbury South and Low Hill': 'Bushbury South & Low Hill',
+    'Bournville': 'Bournville & Cotteridge',
+    'Spring Vale': 'Ettingshall South & Spring Vale',
+    'Longbridge': 'Longbridge & West Heath',
+    'Sparkbrook': 'Sparkbrook & Balsall Heath East',
+    'Hodge Hill': 'Bromford & Hodge Hill',
+    'Moseley and Kings Heath': 'Moseley',
+    'Brandwood': "Brandwood & King's Heath",
+    'Soho': "Soho & Jewellery Quarter",
+    'Bilston East': "Bilston South",
+    'Lozells and East Handsworth': 'Lozells',
+    'Ettingshall': 'Ettingshall North',
+    'Stechford and Yardley North': 'Yardley West & Stechford',
+    'Washwood Heath': 'Bromford & Hodge Hill',
+    'Sutton New Hall': 'Sutton Walmley & Minworth',
+    'Springfield': 'Hall Green North',
+    'Hall Green': 'Hall Green South',
+    'Kings Norton': "King's Norton South",
+    'Tyburn': "Erdington",
+    'Weoley': "Weoley & Selly Oak",
+    'Selly Oak': "Weoley & Selly Oak"
+}
+
+# tokeniser for incident description ngrams
+word_regex = re.compile(r"[a-z]+(?:'[a-z]+)*")
+
+
+@lru_cache(maxsize=8)
+def _england_holidays(first_year, last_year):
+    '''Function returning bank holiday dates in England as a datetime64 array'''
+    import holidays
+
+    eng_hol = holidays.country_holidays('GB', subdiv='ENG', years=range(first_year, last_year+1))
+    hol_dates = np.array(list(eng_hol.keys()), dtype='datetime64[D]')
+    # shared between calls via the cache, so guard against modification
+    hol_dates.flags.writeable = False
+
+    return hol_dates
 
 
 def add_time_dimensions(to_prep, date_col='Incdate'):
     '''Function that converts datetime to financial year, week, month and checks for holidays'''
-    # add helper columns for various date dimensions
-    to_prep.loc[:, 'fin_year'] = to_prep[date_col].dt.to_period('Q-MAR').dt.qyear - 1
-    to_prep.loc[:, 'month'] = to_prep[date_col].dt.to_period('M').dt.start_time
-    to_prep.loc[:, 'week'] = to_prep[date_col].dt.to_period('W').dt.start_time
-    to_prep.loc[:, 'weekday'] = to_prep[date_col].dt.day_of_week
+    # add helper columns for various date dimensions using datetime64 arithmetic,
+    # on local wall-clock time, as numpy would otherwise convert to UTC
+    inc_times = to_prep[date_col]
+    if inc_times.dt.tz is not None:
+        inc_times = inc_times.dt.tz_localize(None)
+    inc_times = inc_times.to_numpy()
+    inc_dates = inc_times.astype('datetime64[D]')
+    inc_months = inc_times.astype('datetime64[M]')
+    # financial years start in April, months are counted from Jan 1970
+    to_prep['fin_year'] = pd.Series(
+        1970 + (inc_months.astype('int64') - 3) // 12, index=to_prep.index
+    ).mask(np.isnat(inc_times))
+    to_prep['month'] = inc_months.astype(inc_times.dtype)
+    # weeks start on Monday, days are counted from Thursday 1 Jan 1970
+    to_prep['week'] = (inc_dates - (inc_dates.astype('int64') + 3) % 7).astype(inc_times.dtype)
+    to_prep['weekday'] = to_prep[date_col].dt.day_of_week
 
     # import holidays dats in England
-    eng_hol = holidays.country_holidays(
-        'GB', subdiv='ENG',
-        years=range(to_prep[date_col].min().year, to_prep[date_col].max().year+1)
-    )
+    hol_dates = _england_holidays(to_prep[date_col].min().year, to_prep[date_col].max().year)
 
     # add helper column to indicate if incident date was a holiday or weekend
-    to_prep.loc[:, 'BH_or_WE'] = 'No'
-    to_prep.loc[to_prep.weekday.isin([5,6]), 'BH_or_WE'] = 'Weekend'
-    to_prep.loc[to_prep[date_col].dt.date.isin(eng_hol), 'BH_or_WE'] = 'Bank Holiday'
+    to_prep['BH_or_WE'] = pd.Categorical(
+        np.select(
+            [np.isin(inc_dates, hol_dates), to_prep.weekday.to_numpy() >= 5],
+            ['Bank Holiday', 'Weekend'],
+            default='No'
+        ),
+        categories=['No', 'Weekend', 'Bank Holiday']
+    )
 
     return to_prep
 
 
+@lru_cache(maxsize=8)
+def _animal_patterns(kw_items):
+    '''Function to compile each animal's keyword list into a lowercase regex'''
+    return tuple(
+        re.compile('|'.join(re.escape(kw.lower()) for kw in keyword_list))
+        for _, keyword_list in kw_items
+    )
+
+
 def group_animals(to_prep, animal_kw_dict, desc_col='Incident Detail'):
     '''Function to group animal into supertypes based on keyword dict'''
-    # parse animal keywords and group into animal supertypes
-    for animal, keyword_list in animal_kw_dict.items():
-        to_prep.loc[
-            to_prep[desc_col].str.lower().str.contains('|'.join(keyword_list)),
-            'animal'
-        ] = animal
-    
+    # parse animal keywords and group into animal supertypes; later animals
+    # take priority, so np.select is given them first
+    kw_items = tuple((animal, tuple(kws)) for animal, kws in animal_kw_dict.items())
+    animals = [animal for animal, _ in kw_items]
+    # lowercase once, IGNORECASE regexes are several times slower to search
+    descs = to_prep[desc_col].str.lower()
+    masks = [
+        descs.str.contains(pattern, na=False).to_numpy(dtype=bool)
+        for pattern in _animal_patterns(kw_items)
+    ]
+
+    to_prep['animal'] = pd.Categorical(
+        np.select(masks[::-1], animals[::-1], default=None),
+        categories=sorted(animals)
+    ).remove_unused_categories()
+
     return to_prep
 
 
 def modify_wards(to_prep, ward_col='Ward'):
     '''Function to align ward names in to_prep to post-2018 ward names'''
-    # rename wards
-    to_prep.loc[:, ward_col] = to_prep.Ward.str.replace(' Ward', '').copy()
-    to_prep.loc[to_prep.Ward.isin(["St. Peter's", "St Peter's"]), ward_col] = 'St Peters'
-    to_prep.loc[to_prep.Ward == "St. Michael's", ward_col] = "St Michael's"
-    to_prep.loc[to_prep.Ward == "St. Pauls", ward_col] = 'St Pauls'
-
-    # messy, manual reallocation of old wards to new ones post 2018
-    to_prep.loc[to_prep.Ward == 'Bushbury South and Low Hill', ward_col] = 'Bushbury South & Low Hill'
-    to_prep.loc[to_prep.Ward == 'Bournville', ward_col] = 'Bournville & Cotteridge'
-    to_prep.loc[to_prep.Ward == 'Spring Vale', ward_col] = 'Ettingshall South & Spring Vale'
-    to_prep.loc[to_prep.Ward == 'Longbridge', ward_col] = 'Longbridge & West Heath'
-    to_prep.loc[to_prep.Ward == 'Sparkbrook', ward_col] = 'Sparkbrook & Balsall Heath East'
-    to_prep.loc[to_prep.Ward == 'Hodge Hill', ward_col] = 'Bromford & Hodge Hill'
-    to_prep.loc[to_prep.Ward == 'Moseley and Kings Heath', ward_col] = 'Moseley'
-    to_prep.loc[to_prep.Ward == 'Brandwood', ward_col] = "Brandwood & King's Heath"
-    to_prep.loc[to_prep.Ward == 'Soho', ward_col] = "Soho & Jewellery Quarter"
-    to_prep.loc[to_prep.Ward == 'Bilston East', ward_col] = "Bilston South"
-    to_prep.loc[to_prep.Ward == 'Lozells and East Handsworth', ward_col] = 'Lozells'
-    to_prep.loc[to_prep.Ward == 'Ettingshall', ward_col] = 'Ettingshall North'
-    to_prep.loc[to_prep.Ward == 'Stechford and Yardley North', ward_col] = 'Yardley West & Stechford'
-    to_prep.loc[to_prep.Ward == 'Washwood Heath', ward_col] = 'Bromford & Hodge Hill'
-    to_prep.loc[to_prep.Ward == 'Sutton New Hall', ward_col] = 'Sutton Walmley & Minworth'
-    to_prep.loc[to_prep.Ward == 'Springfield', ward_col] = 'Hall Green North'
-    to_prep.loc[to_prep.Ward == 'Hall Green', ward_col] = 'Hall Green South'
-    to_prep.loc[to_prep.Ward == 'Kings Norton', ward_col] = "King's Norton South"
-    to_prep.loc[to_prep.Ward == 'Tyburn', ward_col] = "Erdington"
-    to_prep.loc[to_prep.Ward.isin(['Weoley', 'Selly Oak']), ward_col] = "Weoley & Selly Oak"
-
-    to_prep.loc[to_prep.Ward == 'Tipton Green', 'District'] = "Sandwell"
+    # rename wards and reallocate old wards to new ones in one hash lookup
+    # per row (Series.replace with a dict scans the column once per key)
+    wards = to_prep[ward_col].str.replace(' Ward', '', regex=False)
+    wards = wards.map(ward_renames).fillna(wards)
+    districts = to_prep.District.mask(wards == 'Tipton Green', 'Sandwell')
+
+    # low cardinality columns, so store as categories
+    return to_prep.assign(
+        **{ward_col: wards.astype('category'), 'District': districts.astype('category')}
+    )
 
-    return to_prep
+
+def _download_ward_kml(id):
+    '''Function to download a single ward KML file from Doogal'''
+    kml = urlopen(f"https://www.doogal.co.uk/kml/wards/E0{id}.kml").read()
+    dist_name = ET.fromstring(kml)[0][1][1].text
+    filename = Path(f'kml/{dist_name}.kml')
+    filename.write_bytes(kml)
 
 
-def download_district_kml(doogal_dict):
+def download_district_kml(doogal_dict, max_workers=16):
     '''Function to download Postcode KML files from Doogal'''
-    for district, (kml_start, kml_end) in doogal_dict.items():
-        for id in range(kml_start, kml_end+1):
-            print(id)
-            kml = urlopen(f"https://www.doogal.co.uk/kml/wards/E0{id}.kml").read()
-            dist_name = ET.fromstring(kml)[0][1][1].text
-            filename = Path(f'kml/{dist_name}.kml')
-            filename.write_bytes(kml)
+    ids = [
+        id
+        for kml_start, kml_end in doogal_dict.values()
+        for id in range(kml_start, kml_end+1)
+    ]
+    # downloads are network bound, so fetch them concurrently
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(_download_ward_kml, ids))
 
 
 def load_and_combine_kml(kml_dir='kml'):
     '''Function for loading and combining KML files in target directory'''
-    kml = gpd.GeoDataFrame()
-    for kml_file in glob.glob(f'{kml_dir}/*.kml'):
-        kml = pd.concat([kml, gpd.read_file(kml_file)])
-    
-    return kml
+    import geopandas as gpd
+
+    # pyogrio reads each file in bulk through GDAL rather than feature by feature
+    read_kml = partial(gpd.read_file, engine='pyogrio')
+    with ThreadPoolExecutor() as executor:
+        kml_frames = list(executor.map(read_kml, glob.glob(f'{kml_dir}/*.kml')))
+
+    if not kml_frames:
+        return gpd.GeoDataFrame()
+
+    return pd.concat(kml_frames, ignore_index=True)
+
+
+def _normalise_map_wards(wards):
+    '''Function to align ward names with census ward names'''
+    wards = wards.str.replace("'", '')
+
+    return wards.mask(wards.str.contains('Ettingshall'), 'Ettingshall')
 
 
 def combine_maps_w_data(kml_data, inc_data, census_data):
-    map_data = (
-        kml_data
-        .join(
-            (
-                inc_data
-                .groupby(['fin_year', 'District', 'Ward']).size()
-                .unstack('fin_year').fillna(0)
-                .assign(Total_Incidents=lambda x: x.sum(axis=1))
-                .reset_index(level=0)
-            ),
-            how='left',
-            on='Ward'
-        )
+    # merge ward shapes first, so only geometry needs dissolving
+    ward_shapes = (
+        kml_data[['Ward', 'geometry']]
+        .assign(Ward=lambda x: _normalise_map_wards(x.Ward))
+        .dissolve(by='Ward')
+        .reset_index()
     )
 
-    map_data.loc[:, 'Ward'] = map_data.Ward.str.replace("'", '')
+    inc_data = inc_data.assign(Ward=lambda x: _normalise_map_wards(x.Ward.astype(str)))
 
-    map_data.loc[
-        map_data.Ward.str.contains('Ettingshall'), 'Ward'
-    ] = 'Ettingshall'
+    # count by ward only, a ward can appear under more than one district
+    inc_by_ward = (
+        inc_data
+        .groupby(['fin_year', 'Ward'], observed=True).size()
+        .unstack('fin_year').fillna(0)
+        .assign(Total_Incidents=lambda x: x.sum(axis=1))
+    )
+    # use the district most incidents in the ward were recorded under, wards
+    # with no recorded district are left blank after the merge
+    inc_by_ward.insert(
+        0, 'District',
+        inc_data
+        .dropna(subset=['District'])
+        .groupby('Ward').District.agg(lambda x: x.mode().iloc[0])
+        .astype(str)
+    )
 
-    map_data = map_data.dissolve(by='Ward', aggfunc='sum', numeric_only=False).reset_index()
+    map_data = (
+        ward_shapes
+        .merge(inc_by_ward, how='left', left_on='Ward', right_index=True, validate='many_to_one')
+        .fillna({'District': ''})
+    )
 
     map_data.loc[
         map_data.Ward.isin(['Castle Vale', 'Allens Cross']),
@@ -162,27 +250,67 @@ def combine_maps_w_data(kml_data, inc_data, census_data):
     return map_data
 
 
-def fit_and_predict(to_fit, p=30, f='d'):
-    m = prophet.Prophet()
-    m.add_country_holidays(country_name='GB')
-    m.fit(to_fit)
+def fit_and_predict(to_fit, p=30, f='d', cache_dir='.cache'):
+    import prophet
+    from prophet.plot import plot_components_plotly
+    from prophet.serialize import model_from_json, model_to_json
+
+    # fitting is slow, so reuse a model previously fitted on identical data
+    # with the same prophet version
+    data_hash = hashlib.sha256(f'{prophet.__version__}{list(to_fit.columns)}'.encode())
+    data_hash.update(pd.util.hash_pandas_object(to_fit).to_numpy().tobytes())
+    model_file = Path(cache_dir) / f'prophet_{data_hash.hexdigest()}.json'
+
+    m = None
+    if model_file.exists():
+        try:
+            m = model_from_json(model_file.read_text())
+        except (ValueError, KeyError):
+            # truncated or incompatible cache file, so refit and overwrite it
+            m = None
+
+    if m is None:
+        m = prophet.Prophet()
+        m.add_country_holidays(country_name='GB')
+        m.fit(to_fit)
+        # write to a temporary file first, so an interrupted write can't
+        # leave a truncated model in the cache
+        model_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = model_file.with_name(f'{model_file.name}.{os.getpid()}.tmp')
+        tmp_file.write_text(model_to_json(m))
+        tmp_file.replace(model_file)
+
     future = m.make_future_dataframe(periods=p, freq=f)
     forecast = m.predict(future)
 
     return plot_components_plotly(m, forecast, uncertainty=False)
 
 
+@lru_cache(maxsize=None)
+def _english_stopwords():
+    from nltk.corpus import stopwords
+
+    return frozenset(stopwords.words("english"))
+
+
 def filter_stopwords(q):
-    filtered_list = []
-    for word in word_tokenize(q):
-        if word.casefold() not in set(stopwords.words("english")):
-            filtered_list.append(word)
-    return filtered_list
+    english_stopwords = _english_stopwords()
+    return [word for word in word_regex.findall(q.lower()) if word not in english_stopwords]
 
 
 def get_ngrams(s, n=2):
-    return [gram for gram in ngrams(s, n)]
+    return list(zip(*(s[i:] for i in range(n))))
 
 
 def ngram_counts(data, n=2, col='Incident Detail'):
-    return pd.Series([x for t in data[col].apply(filter_stopwords).apply(get_ngrams, args=(n,)).values for x in t]).value_counts()
+    # tokenise, filter and count ngrams row by row without intermediate series
+    counts = Counter()
+    for desc in data[col]:
+        counts.update(get_ngrams(filter_stopwords(desc), n))
+
+    return pd.Series(
+        list(counts.values()),
+        index=pd.Index(list(counts.keys()), tupleize_cols=False),
+        name='count',
+        dtype='int64'
+    ).sort_values(ascending=False)